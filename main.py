@@ -4,22 +4,58 @@ import os
 # Load environment variables from .env file
 load_dotenv()
 
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, BackgroundTasks
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import ORJSONResponse, StreamingResponse
 from pydantic import BaseModel
-import hashlib
-import requests
-from typing import List, Dict, Optional, Any, Union
-import json
+import httpx
+import asyncio
+from typing import List, Dict, Optional, Any, Union, Tuple
+import orjson
 from datetime import datetime
-import time
 import random
+from contextlib import asynccontextmanager
+from dataclasses import dataclass
+from collections import Counter
+
+import redis.asyncio as redis_asyncio
 
 # Importações para Google Sheets
 import gspread
 from google.oauth2.service_account import Credentials
+from google.auth.exceptions import RefreshError
+from google.auth.transport.requests import Request as GoogleAuthRequest
 
-app = FastAPI(title="API Fila de Corretores", version="1.0.0")
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Com Redis, a posição da fila é gravada na planilha periodicamente
+    tarefa_sync = asyncio.create_task(_sincronizar_redis_periodicamente()) if REDIS_URL else None
+    
+    yield
+    
+    if tarefa_sync is not None:
+        tarefa_sync.cancel()
+        try:
+            await tarefa_sync
+        except asyncio.CancelledError:
+            pass
+        # Última gravação antes de encerrar, para não perder a posição mais recente
+        await _flush_posicao_redis()
+        await fechar_redis()
+    
+    # Aguarda uma gravação da posição ainda agendada, para não perdê-la
+    if _tarefa_flush_posicao is not None and not _tarefa_flush_posicao.done():
+        await _tarefa_flush_posicao
+    
+    # Fecha as conexões mantidas abertas com a Evolution API
+    await fechar_http_client()
+
+app = FastAPI(
+    title="API Fila de Corretores",
+    version="1.0.0",
+    lifespan=lifespan,
+    default_response_class=ORJSONResponse
+)
 
 # CORS middleware
 app.add_middleware(
@@ -37,6 +73,20 @@ class Corretor(BaseModel):
     telefone: str
     posicao_fila: int
 
+@dataclass(slots=True)
+class CorretorInternal:
+    """
+    Representação interna do corretor usada no processamento da fila (sem validação
+    do Pydantic). Convertida em Corretor apenas ao montar a resposta.
+    """
+    nome: str
+    email: str
+    telefone: str
+    posicao_fila: int
+    
+    def to_model(self) -> Corretor:
+        return Corretor(nome=self.nome, email=self.email, telefone=self.telefone, posicao_fila=self.posicao_fila)
+
 class NotificacaoStatus(BaseModel):
     corretor_nome: str
     telefone: str
@@ -50,6 +100,7 @@ class FilaResponse(BaseModel):
     timestamp: str
     fila_alterada: bool
     notificacoes_whatsapp: List[NotificacaoStatus] = []
+    notificacoes_agendadas: bool = False
 
 # Configurações (usar variáveis de ambiente na produção)
 SPREADSHEET_ID = os.getenv("SPREADSHEET_ID", "")
@@ -57,64 +108,173 @@ EVOLUTION_API_URL = os.getenv("EVOLUTION_API_URL", "")
 EVOLUTION_API_KEY = os.getenv("EVOLUTION_API_KEY", "")
 GOOGLE_CREDENTIALS_JSON = os.getenv("GOOGLE_CREDENTIALS_JSON", "{}")
 
-# Cache para controle de mudanças
-cache_hash = None
-cache_fila = []
-cache_corretores_anteriores = []  # Para detectar mudanças específicas
+# Redis (ex.: Upstash) para guardar a posição da fila; opcional. Quando configurado,
+# a planilha vira armazenamento frio, sincronizado a cada SYNC_SHEETS_INTERVALO segundos
+REDIS_URL = os.getenv("REDIS_URL", "")
+REDIS_FILA_KEY = "fila_position"
+SYNC_SHEETS_INTERVALO = 60
+# Limite (segundos) para conectar e para cada comando no Redis: com ele fora do ar,
+# a requisição cai logo no fallback da planilha em vez de ficar presa segurando _fila_lock
+REDIS_TIMEOUT = 2
+
+# Google Sheets configurado corretamente (avaliado uma vez: as variáveis de ambiente
+# não mudam durante a execução do processo)
+_SHEETS_OK = bool(SPREADSHEET_ID and SPREADSHEET_ID != "placeholder_sheet_id" and 
+                  GOOGLE_CREDENTIALS_JSON and GOOGLE_CREDENTIALS_JSON != "{}" and 
+                  GOOGLE_CREDENTIALS_JSON != '{"type":"service_account","project_id":"placeholder"}')
+
+# Envio de notificações WhatsApp: os inícios dos envios são espaçados por um intervalo
+# aleatório (segundos) para evitar banimento da API; as requisições em andamento podem
+# se sobrepor ao intervalo, limitadas a NOTIFICACOES_CONCORRENCIA simultâneas
+NOTIFICACOES_CONCORRENCIA = 3
+NOTIFICACOES_INTERVALO_MIN = 3.0
+NOTIFICACOES_INTERVALO_MAX = 8.0
+
+# Mensagens WhatsApp enviadas aos corretores (preenchidas com str.format_map)
+_TPL_FIRST = """🎯 *AGORA É SUA VEZ!*
+
+Olá {nome}! 
+
+Você está em *1º lugar* na fila de atendimento! 📞
+
+O próximo cliente será direcionado para você.
+
+_Equipe Realiza Imóveis_ 🏡"""
+
+_TPL_OTHER = """📋 *POSIÇÃO NA FILA ATUALIZADA*
+
+Olá {nome}!
+
+Sua posição atual: *{pos}º lugar* 
+
+🎯 Corretor atual: {atual}
+
+_Equipe Realiza Imóveis_ 🏡"""
+
+# Espera (segundos) antes de gravar a posição da fila na planilha; avanços feitos
+# nesse intervalo são agrupados em uma única escrita
+SYNC_POSICAO_DEBOUNCE = 2.0
+
+# Pool de conexões HTTP com a Evolution API (keep-alive entre envios e requisições)
+HTTP_POOL_LIMITS = httpx.Limits(max_keepalive_connections=4, max_connections=8)
+
+# Cache para controle de mudanças: nomes dos corretores da última leitura (na ordem
+# da planilha) e índice nome -> posição mantido em sincronia
+cache_estado = {"nomes": (), "indice": {}}
 
 # Variável para armazenar posição da fila em memória (fallback)
 memoria_fila_position = 0
 
-def detectar_mudancas_planilha(corretores_atuais: List[Corretor]):
+# Indica que a posição em memória ainda não foi gravada na planilha
+posicao_pendente_sync = False
+
+# Serializa leitura e atualização da posição da fila entre requisições simultâneas
+_fila_lock = asyncio.Lock()
+
+# Tarefa que grava na planilha a posição pendente (mantida aqui para não ser coletada)
+_tarefa_flush_posicao = None
+
+# Cliente HTTP da Evolution API reutilizado entre requisições (criado sob demanda)
+_http_client = None
+
+# Cliente Redis reutilizado entre requisições (criado sob demanda, se REDIS_URL definido)
+_redis_client = None
+
+# A última gravação no Redis falhou e o valor lá pode estar defasado em relação à memória
+_redis_desatualizado = False
+
+# Conexão com o Google Sheets reutilizada entre requisições (criada sob demanda)
+_client_singleton = None
+_spreadsheet_singleton = None
+_corretores_ws_singleton = None
+_config_ws_singleton = None
+
+# Última leitura das linhas de corretores, válida enquanto o modifiedTime (Drive API)
+# não mudar. Só é usada quando a posição vem do Redis: a posição (Config!A2) nunca
+# entra no cache
+_rows_cache = {"mtime": None, "records": []}
+
+# Falso depois que a consulta ao modifiedTime falhar (ex.: Drive API desativada):
+# a partir daí as linhas são sempre lidas, sem tentar a consulta a cada requisição
+_revisao_drive_disponivel = True
+
+def indexar_nomes(nomes: Tuple[str, ...]) -> Dict[str, int]:
+    """Monta o índice nome -> posição na lista (em nomes repetidos vale a primeira ocorrência)"""
+    indice = {}
+    for i, nome in enumerate(nomes):
+        if nome not in indice:
+            indice[nome] = i
+    return indice
+
+def atualizar_cache_corretores(nomes: Tuple[str, ...], indice: Optional[Dict[str, int]] = None):
+    """Substitui o cache de corretores e o índice nome -> posição correspondente"""
+    global cache_estado
+    
+    cache_estado = {
+        "nomes": nomes,
+        "indice": indice if indice is not None else indexar_nomes(nomes)
+    }
+
+def detectar_mudancas_planilha(corretores_atuais: List[CorretorInternal]):
     """
     Detecta mudanças específicas na planilha (adições e remoções)
     Retorna informações sobre as mudanças detectadas
     """
-    global cache_corretores_anteriores
+    # Uma única passada pela lista atual: os nomes e o índice servem para a
+    # comparação e para o cache
+    nomes_atuais = tuple(c.nome for c in corretores_atuais)
+    indice_atual = indexar_nomes(nomes_atuais)
     
-    if not cache_corretores_anteriores:
+    if not cache_estado["nomes"]:
         # Primeira execução
-        cache_corretores_anteriores = corretores_atuais.copy()
+        atualizar_cache_corretores(nomes_atuais, indice_atual)
         return {
             "houve_mudanca": True,
             "primeira_execucao": True,
             "adicionados": [],
             "removidos": [],
             "total_anterior": 0,
-            "total_atual": len(corretores_atuais)
+            "total_atual": len(corretores_atuais),
+            "indice_anterior": {}
         }
     
-    # Cria sets para comparação mais eficiente
-    nomes_anteriores = {c.nome for c in cache_corretores_anteriores}
-    nomes_atuais = {c.nome for c in corretores_atuais}
+    # Guarda o índice de antes da mudança para localizar os corretores removidos
+    indice_anterior = cache_estado["indice"]
+    total_anterior = len(cache_estado["nomes"])
     
-    # Detecta adições e remoções
-    adicionados = list(nomes_atuais - nomes_anteriores)
-    removidos = list(nomes_anteriores - nomes_atuais)
+    # Detecta adições e remoções (na ordem da planilha)
+    adicionados = [nome for nome in indice_atual if nome not in indice_anterior]
+    removidos = [nome for nome in indice_anterior if nome not in indice_atual]
     
     houve_mudanca = len(adicionados) > 0 or len(removidos) > 0
     
     if houve_mudanca:
-        # Atualiza o cache
-        cache_corretores_anteriores = corretores_atuais.copy()
+        # Atualiza o cache reaproveitando os nomes e o índice já montados
+        atualizar_cache_corretores(nomes_atuais, indice_atual)
     
     return {
         "houve_mudanca": houve_mudanca,
         "primeira_execucao": False,
         "adicionados": adicionados,
         "removidos": removidos,
-        "total_anterior": len(cache_corretores_anteriores) if not houve_mudanca else len(cache_corretores_anteriores) - len(adicionados) + len(removidos),
-        "total_atual": len(corretores_atuais)
+        "total_anterior": total_anterior,
+        "total_atual": len(corretores_atuais),
+        "indice_anterior": indice_anterior
     }
 
-def ajustar_posicao_fila_por_mudancas(mudancas: dict, posicao_atual: int, corretores_atuais: List[Corretor]):
+def ajustar_posicao_fila_por_mudancas(mudancas: dict, posicao_atual: int, corretores_atuais: List[CorretorInternal]):
     """
     Ajusta a posição da fila baseado nas mudanças detectadas
     """
     global memoria_fila_position
     
     if mudancas["primeira_execucao"]:
-        print("Primeira execução - iniciando fila na posição 0")
+        # Sem leitura anterior para comparar (processo novo): mantém a posição salva
+        # (Redis, Config!A2 ou memória). Outras instâncias podem estar usando a mesma fila
+        if 0 <= posicao_atual < len(corretores_atuais):
+            print(f"Primeira execução - mantendo a posição salva da fila: {posicao_atual}")
+            return posicao_atual
+        print("Primeira execução - posição salva fora da fila, iniciando na posição 0")
         return 0
     
     if not mudancas["houve_mudanca"]:
@@ -133,22 +293,19 @@ def ajustar_posicao_fila_por_mudancas(mudancas: dict, posicao_atual: int, corret
         # Encontra a posição original dos corretores removidos
         for nome_removido in mudancas["removidos"]:
             # Encontra onde estava o corretor removido baseado no cache anterior
-            posicao_removido = None
-            for i, corretor in enumerate(cache_corretores_anteriores):
-                if corretor.nome == nome_removido:
-                    posicao_removido = i
-                    break
+            posicao_removido = mudancas["indice_anterior"].get(nome_removido)
             
             if posicao_removido is not None:
                 print(f"  - Corretor '{nome_removido}' estava na posição {posicao_removido}")
                 print(f"  - Posição atual antes do ajuste: {nova_posicao}")
                 
-                # Se o corretor removido estava antes da posição atual
-                if posicao_removido < nova_posicao:
+                # Compara sempre com a posição original: os índices do cache anterior
+                # são anteriores a todas as remoções
+                if posicao_removido < posicao_atual:
                     nova_posicao -= 1
                     print(f"    -> Ajustando posição: {nova_posicao + 1} → {nova_posicao}")
                 # Se o corretor removido era exatamente o atual
-                elif posicao_removido == nova_posicao:
+                elif posicao_removido == posicao_atual:
                     # Mantém a posição, mas pode precisar ajustar se passou do limite
                     print(f"    -> Corretor atual foi removido, verificando limites")
     
@@ -168,252 +325,704 @@ def ajustar_posicao_fila_por_mudancas(mudancas: dict, posicao_atual: int, corret
     print(f"Posição da fila ajustada: {posicao_atual} → {nova_posicao}")
     return nova_posicao
 
-def is_google_sheets_configured():
-    """Verifica se o Google Sheets está configurado corretamente"""
-    return (SPREADSHEET_ID and SPREADSHEET_ID != "placeholder_sheet_id" and 
-            GOOGLE_CREDENTIALS_JSON and GOOGLE_CREDENTIALS_JSON != "{}" and 
-            GOOGLE_CREDENTIALS_JSON != '{"type":"service_account","project_id":"placeholder"}')
+SCOPES = [
+    'https://www.googleapis.com/auth/spreadsheets',
+    'https://www.googleapis.com/auth/drive'
+]
+
+def _carregar_credenciais():
+    """
+    Carrega as credenciais da conta de serviço a partir do JSON (variável de ambiente).
+    Executado uma única vez, na importação do módulo. Retorna (credenciais, erro).
+    """
+    if not _SHEETS_OK:
+        return None, None
+    
+    try:
+        creds_dict = orjson.loads(GOOGLE_CREDENTIALS_JSON)
+        return Credentials.from_service_account_info(creds_dict, scopes=SCOPES), None
+    except Exception as e:
+        print(f"⚠️ Erro ao carregar credenciais do Google: {str(e)}")
+        return None, str(e)
+
+_CREDS, _CREDS_ERRO = _carregar_credenciais()
 
 def get_google_sheets_client():
-    """Inicializa cliente do Google Sheets"""
-    if not is_google_sheets_configured():
+    """Retorna o cliente do Google Sheets, autenticando apenas na primeira chamada"""
+    global _client_singleton
+    
+    if not _SHEETS_OK:
         raise Exception("Google Sheets não configurado")
     
+    if _client_singleton is not None:
+        return _client_singleton
+    
+    if _CREDS is None:
+        raise HTTPException(status_code=500, detail=f"Erro ao conectar Google Sheets: {_CREDS_ERRO}")
+    
     try:
-        # Carrega credenciais do JSON (variável de ambiente)
-        creds_dict = json.loads(GOOGLE_CREDENTIALS_JSON)
-        
-        scopes = [
-            'https://www.googleapis.com/auth/spreadsheets',
-            'https://www.googleapis.com/auth/drive'
-        ]
-        
-        credentials = Credentials.from_service_account_info(creds_dict, scopes=scopes)
-        client = gspread.authorize(credentials)
-        return client
+        _client_singleton = gspread.authorize(_CREDS)
+        return _client_singleton
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Erro ao conectar Google Sheets: {str(e)}")
 
-def get_corretores_from_sheets():
-    """Busca lista de corretores da planilha do Google Sheets"""
-    if not is_google_sheets_configured():
-        raise HTTPException(status_code=500, detail="Google Sheets não está configurado. Verifique as variáveis de ambiente.")
+def get_spreadsheet():
+    """Retorna a planilha (em cache) aberta pelo SPREADSHEET_ID"""
+    global _spreadsheet_singleton
     
+    if _spreadsheet_singleton is None:
+        _spreadsheet_singleton = get_google_sheets_client().open_by_key(SPREADSHEET_ID)
+    return _spreadsheet_singleton
+
+def get_corretores_worksheet():
+    """Retorna a primeira aba da planilha (em cache), onde ficam os corretores"""
+    global _corretores_ws_singleton
+    
+    if _corretores_ws_singleton is None:
+        _corretores_ws_singleton = get_spreadsheet().sheet1
+    return _corretores_ws_singleton
+
+def get_config_worksheet():
+    """
+    Retorna a aba 'Config' (em cache).
+    Lança gspread.exceptions.WorksheetNotFound se a aba não existir.
+    """
+    global _config_ws_singleton
+    
+    if _config_ws_singleton is None:
+        _config_ws_singleton = get_spreadsheet().worksheet('Config')
+    return _config_ws_singleton
+
+def criar_config_worksheet():
+    """Cria a aba 'Config' com a posição atual da memória e a guarda em cache"""
+    global _config_ws_singleton
+    
+    config_sheet = get_spreadsheet().add_worksheet(title='Config', rows=10, cols=2)
+    config_sheet.update('A1', 'fila_position')
+    config_sheet.update('A2', str(memoria_fila_position))
+    _config_ws_singleton = config_sheet
+    return config_sheet
+
+def _limpar_cache_linhas():
+    """Descarta a última leitura da planilha (a próxima chamada relê os dados)"""
+    global _rows_cache
+    
+    _rows_cache = {"mtime": None, "records": []}
+
+def invalidar_cache_google_sheets():
+    """Descarta cliente, planilha e abas em cache (serão recriados na próxima chamada)"""
+    global _client_singleton, _spreadsheet_singleton, _corretores_ws_singleton, _config_ws_singleton
+    
+    _client_singleton = None
+    _spreadsheet_singleton = None
+    _corretores_ws_singleton = None
+    _config_ws_singleton = None
+    _limpar_cache_linhas()
+
+def executar_no_google_sheets(operacao):
+    """
+    Executa uma operação no Google Sheets usando a conexão em cache.
+    Se as credenciais não puderem ser renovadas ou o token for recusado (401),
+    descarta o cache, renova o token e tenta novamente uma vez.
+    """
     try:
-        client = get_google_sheets_client()
-        sheet = client.open_by_key(SPREADSHEET_ID).sheet1
+        return operacao()
+    except (RefreshError, gspread.exceptions.APIError) as e:
+        if isinstance(e, gspread.exceptions.APIError) and e.code != 401:
+            raise
+        print(f"🔄 Credenciais do Google expiradas ({str(e)}), reconectando...")
+        invalidar_cache_google_sheets()
+        _CREDS.refresh(GoogleAuthRequest())
+        return operacao()
+
+def corretores_from_records(records: List[Dict[str, Any]]) -> List[CorretorInternal]:
+    """Converte as linhas da planilha (nome, email, telefone) em corretores na ordem da fila"""
+    corretores = []
+    for i, record in enumerate(records):
+        # Converte valores para string para garantir que .strip() funcione
+        nome = str(record.get('nome', ''))
+        email = str(record.get('email', ''))
+        telefone = str(record.get('telefone', ''))
         
-        # Pega todos os dados (assumindo header na primeira linha)
-        records = sheet.get_all_records()
+        corretor = CorretorInternal(
+            nome=nome.strip(),
+            email=email.strip(),
+            telefone=telefone.strip(),
+            posicao_fila=i + 1
+        )
+        corretores.append(corretor)
+    
+    return corretores
+
+def _batch_get_estado(incluir_config: bool = True):
+    """
+    Lê em uma única chamada (spreadsheets.values.batchGet) a aba de corretores e a
+    célula Config!A2. Retorna (linhas, posição bruta, se a aba Config existe).
+    Com incluir_config=False lê só a aba de corretores (posição None).
+    """
+    ranges = [gspread.utils.absolute_range_name(get_corretores_worksheet().title)]
+    config_sheet = None
+    if incluir_config:
+        try:
+            config_sheet = get_config_worksheet()
+            ranges.append(gspread.utils.absolute_range_name(config_sheet.title, 'A2'))
+        except gspread.exceptions.WorksheetNotFound:
+            pass
+    
+    value_ranges = get_spreadsheet().values_batch_get(ranges).get("valueRanges", [])
+    
+    linhas = value_ranges[0].get("values", []) if value_ranges else []
+    position = None
+    if config_sheet is not None and len(value_ranges) > 1:
+        valores_config = value_ranges[1].get("values", [])
+        if valores_config and valores_config[0]:
+            position = valores_config[0][0]
+    
+    return linhas, position, config_sheet is not None
+
+def records_from_linhas(linhas: List[List[str]]) -> List[Dict[str, Any]]:
+    """
+    Converte as linhas lidas (primeira linha é o header) em records, com o mesmo
+    resultado de Worksheet.get_all_records(): header sem duplicados e valores
+    numéricos convertidos (numericise_all com os mesmos padrões)
+    """
+    if len(linhas) < 2:
+        return []
+    
+    linhas = gspread.utils.fill_gaps(linhas)
+    keys = linhas[0]
+    
+    duplicados = [key for key, total in Counter(keys).items() if total > 1]
+    if duplicados:
+        raise gspread.exceptions.GSpreadException(
+            f"the header row in the worksheet contains duplicates: {duplicados}"
+        )
+    
+    values = [gspread.utils.numericise_all(linha) for linha in linhas[1:]]
+    return gspread.utils.to_records(keys, values)
+
+def _ler_estado_planilha():
+    """
+    Retorna (records, posição bruta, se a aba Config existe) com um único batchGet.
+    Sem consulta ao modifiedTime: a posição precisa ser lida de qualquer forma e vem
+    na mesma chamada que as linhas, então a consulta só acrescentaria uma ida à API.
+    """
+    linhas, position, config_existe = executar_no_google_sheets(_batch_get_estado)
+    return records_from_linhas(linhas), position, config_existe
+
+def _ler_corretores_planilha():
+    """
+    Retorna só os records da aba de corretores (a posição vem de outro lugar, ex.: Redis).
+    Consulta antes o modifiedTime da planilha (Drive API, sem custo na cota de leitura
+    do Sheets) e só faz o batchGet quando a planilha mudou desde a última leitura.
+    """
+    global _rows_cache, _revisao_drive_disponivel
+    
+    mtime = None
+    if _revisao_drive_disponivel:
+        try:
+            mtime = executar_no_google_sheets(lambda: get_spreadsheet().get_lastUpdateTime())
+        except Exception as e:
+            _revisao_drive_disponivel = False
+            print(f"⚠️ Não foi possível consultar a revisão da planilha ({str(e)}), cache de corretores desativado")
+    
+    if mtime is not None and mtime == _rows_cache["mtime"]:
+        print(f"Planilha sem alterações desde {mtime}, usando corretores em cache")
+        return _rows_cache["records"]
+    
+    linhas, _, _ = executar_no_google_sheets(lambda: _batch_get_estado(incluir_config=False))
+    records = records_from_linhas(linhas)
+    
+    _rows_cache = {"mtime": mtime, "records": records}
+    return records
+
+def load_state(ler_posicao: bool = True):
+    """
+    Busca a lista de corretores e a posição atual da fila com uma única leitura da planilha.
+    Retorna (corretores, fila_position). Com ler_posicao=False (posição mantida no Redis)
+    lê só os corretores e devolve a posição em memória.
+    """
+    if not _SHEETS_OK:
+        raise HTTPException(status_code=500, detail="Google Sheets não está configurado. Verifique as variáveis de ambiente.")
+    
+    try:
+        if ler_posicao:
+            records, position, config_existe = _ler_estado_planilha()
+        else:
+            records, position, config_existe = _ler_corretores_planilha(), None, True
         
         if not records:
             raise HTTPException(status_code=404, detail="Nenhum corretor encontrado na planilha")
         
-        corretores = []
-        for i, record in enumerate(records):
-            # Converte valores para string para garantir que .strip() funcione
-            nome = str(record.get('nome', ''))
-            email = str(record.get('email', ''))
-            telefone = str(record.get('telefone', ''))
-            
-            corretor = Corretor(
-                nome=nome.strip(),
-                email=email.strip(),
-                telefone=telefone.strip(),
-                posicao_fila=i + 1
-            )
-            corretores.append(corretor)
-        
-        return corretores
+        corretores = corretores_from_records(records)
     except Exception as e:
+        invalidar_cache_google_sheets()
         raise HTTPException(status_code=500, detail=f"Erro ao ler planilha: {str(e)}")
+    
+    if not ler_posicao:
+        return corretores, memoria_fila_position
+    
+    if not config_existe:
+        print("Aba Config não encontrada no Google Sheets")
+        # Se não existe, cria a aba Config com a posição atual da memória
+        try:
+            criar_config_worksheet()
+            print(f"Aba Config criada no Google Sheets com posição: {memoria_fila_position}")
+        except Exception as create_error:
+            print(f"Erro ao criar aba Config: {str(create_error)}")
+        return corretores, memoria_fila_position
+    
+    return corretores, resolver_posicao_fila(position)
 
-def calculate_sheet_hash(corretores: List[Corretor]) -> str:
-    """Calcula hash da lista de corretores para detectar mudanças"""
-    corretor_strings = [f"{c.nome}|{c.email}|{c.telefone}" for c in corretores]
-    combined_string = "".join(sorted(corretor_strings))
-    return hashlib.md5(combined_string.encode()).hexdigest()
+def montar_fila_rotacionada(corretores: List[CorretorInternal], fila_position: int) -> List[CorretorInternal]:
+    """
+    Retorna a fila a partir da posição atual (corretor atual primeiro, seguido dos
+    próximos), com posicao_fila numerada de 1 a N
+    """
+    if fila_position == 0:
+        # Caso comum (após reset / primeira execução): a lista já está na ordem da
+        # fila e numerada por corretores_from_records
+        return corretores
+    
+    # Rotaciona com fatias em vez de módulo por índice
+    fila = corretores[fila_position:] + corretores[:fila_position]
+    for i, corretor in enumerate(fila):
+        corretor.posicao_fila = i + 1
+    return fila
+
+def resolver_posicao_fila(position) -> int:
+    """Combina a posição lida da aba Config com a posição em memória"""
+    global memoria_fila_position
+    
+    if posicao_pendente_sync:
+        print(f"Sincronização com Google Sheets pendente, usando posição em memória: {memoria_fila_position}")
+        return memoria_fila_position
+    
+    if position is not None and str(position).strip():
+        resultado = int(position)
+        print(f"Posição da fila lida do Google Sheets: {resultado}")
+        
+        # Só atualiza a memória se a posição do Google Sheets for diferente de 0
+        # ou se a memória ainda estiver em 0 (primeira execução)
+        if resultado != 0 or memoria_fila_position == 0:
+            memoria_fila_position = resultado
+            return resultado
+        else:
+            print(f"Google Sheets retornou 0, mantendo posição em memória: {memoria_fila_position}")
+            return memoria_fila_position
+    else:
+        print(f"Posição vazia no Google Sheets, usando memória: {memoria_fila_position}")
+        return memoria_fila_position
 
 def get_fila_position_from_sheets():
     """Busca a posição atual da fila armazenada na planilha ou memória"""
     global memoria_fila_position
     
-    if not is_google_sheets_configured():
+    if not _SHEETS_OK:
         print(f"Google Sheets não configurado, usando posição em memória: {memoria_fila_position}")
         return memoria_fila_position
     
     try:
-        client = get_google_sheets_client()
-        sheet = client.open_by_key(SPREADSHEET_ID)
-        
         # Verifica se existe uma aba 'Config' para armazenar a posição da fila
         try:
-            config_sheet = sheet.worksheet('Config')
-            position = config_sheet.acell('A2').value
-            
-            if position is not None and str(position).strip():
-                resultado = int(position)
-                print(f"Posição da fila lida do Google Sheets: {resultado}")
-                
-                # Só atualiza a memória se a posição do Google Sheets for diferente de 0
-                # ou se a memória ainda estiver em 0 (primeira execução)
-                if resultado != 0 or memoria_fila_position == 0:
-                    memoria_fila_position = resultado
-                    return resultado
-                else:
-                    print(f"Google Sheets retornou 0, mantendo posição em memória: {memoria_fila_position}")
-                    return memoria_fila_position
-            else:
-                print(f"Posição vazia no Google Sheets, usando memória: {memoria_fila_position}")
-                return memoria_fila_position
-                
-        except Exception as e:
-            print(f"Erro ao acessar aba Config: {str(e)}")
+            position = executar_no_google_sheets(lambda: get_config_worksheet().acell('A2').value)
+        except gspread.exceptions.WorksheetNotFound:
+            print("Aba Config não encontrada no Google Sheets")
             # Se não existe, cria a aba Config com a posição atual da memória
             try:
-                config_sheet = sheet.add_worksheet(title='Config', rows=10, cols=2)
-                config_sheet.update('A1', 'fila_position')
-                config_sheet.update('A2', str(memoria_fila_position))
+                criar_config_worksheet()
                 print(f"Aba Config criada no Google Sheets com posição: {memoria_fila_position}")
             except Exception as create_error:
                 print(f"Erro ao criar aba Config: {str(create_error)}")
             
             return memoria_fila_position
+        
+        return resolver_posicao_fila(position)
             
     except Exception as e:
+        invalidar_cache_google_sheets()
         print(f"Erro ao conectar ao Google Sheets: {str(e)}")
         print(f"Usando posição em memória: {memoria_fila_position}")
         return memoria_fila_position
 
-def update_fila_position_in_sheets(position: int):
-    """Atualiza a posição da fila na planilha"""
-    global memoria_fila_position
-    
-    # SEMPRE atualiza em memória primeiro
-    memoria_fila_position = position
-    print(f"Posição da fila atualizada em memória: {position}")
-    
-    if not is_google_sheets_configured():
-        print("Google Sheets não configurado, usando apenas memória")
-        return
+def sincronizar_posicao_no_sheets(position: int) -> bool:
+    """
+    Grava a posição da fila em Config!A2 (spreadsheets.values.batchUpdate).
+    Não falha se der erro: retorna False e a fila continua com controle em memória.
+    """
+    def _escrever():
+        config_sheet = get_config_worksheet()
+        get_spreadsheet().values_batch_update(body={
+            'valueInputOption': 'RAW',
+            'data': [{
+                'range': gspread.utils.absolute_range_name(config_sheet.title, 'A2'),
+                'values': [[position]]
+            }]
+        })
     
-    # Tenta atualizar no Google Sheets (mas não falha se der erro)
     try:
-        client = get_google_sheets_client()
-        sheet = client.open_by_key(SPREADSHEET_ID)
-        
-        # Tenta acessar a aba Config
         try:
-            config_sheet = sheet.worksheet('Config')
-        except:
-            # Se a aba não existe, cria ela
+            executar_no_google_sheets(_escrever)
+        except gspread.exceptions.WorksheetNotFound:
+            # Se a aba não existe, cria ela já com a posição em memória
             print("Aba Config não encontrada, criando...")
-            config_sheet = sheet.add_worksheet(title='Config', rows=10, cols=2)
-            config_sheet.update('A1', 'fila_position')
+            criar_config_worksheet()
             print("Aba Config criada com sucesso")
         
-        # Atualiza a posição usando o método correto
-        config_sheet.update_acell('A2', str(position))
         print(f"✅ Posição da fila sincronizada com Google Sheets: {position}")
+        return True
         
     except Exception as e:
+        invalidar_cache_google_sheets()
         print(f"⚠️ Erro ao sincronizar com Google Sheets: {str(e)}")
         print("✅ Continuando com controle em memória (fila funcionará normalmente)")
+        return False
 
-def send_whatsapp_notifications(fila_corretores: List[Corretor], corretor_atual: Corretor) -> List[NotificacaoStatus]:
+async def _flush_position():
     """
-    Envia notificações WhatsApp para todos os corretores sobre suas posições na fila
-    com delay aleatório entre envios para evitar banimento da API
+    Grava na planilha a posição pendente em memória após SYNC_POSICAO_DEBOUNCE segundos.
+    Atualizações feitas durante a espera são agrupadas em uma única escrita.
     """
-    notificacoes_status = []
+    global posicao_pendente_sync
     
-    if not EVOLUTION_API_URL or not EVOLUTION_API_KEY:
-        print("⚠️ Evolution API não configurada - notificações desabilitadas")
-        return []
+    await asyncio.sleep(SYNC_POSICAO_DEBOUNCE)
     
-    headers = {
-        "Content-Type": "application/json",
-        "apikey": EVOLUTION_API_KEY
-    }
+    # Sob o lock da fila: a posição não muda entre a leitura e a escrita
+    async with _fila_lock:
+        if not posicao_pendente_sync:
+            # Outra tarefa já gravou a posição mais recente
+            return
+        
+        position = memoria_fila_position
+        if not await asyncio.to_thread(sincronizar_posicao_no_sheets, position):
+            # Continua pendente: a memória segue prevalecendo até a próxima escrita
+            return
+        
+        if memoria_fila_position == position:
+            posicao_pendente_sync = False
+
+def _agendar_flush_position():
+    """
+    Agenda _flush_position em uma tarefa própria do event loop, independente das
+    BackgroundTasks da requisição (que rodam em sequência e atrasariam as notificações).
+    Se já houver uma gravação agendada, ela também levará a posição mais recente.
+    """
+    global _tarefa_flush_posicao
+    
+    if _tarefa_flush_posicao is None or _tarefa_flush_posicao.done():
+        _tarefa_flush_posicao = asyncio.create_task(_flush_position())
+
+def update_fila_position_in_sheets(position: int, adiar_escrita: bool = False):
+    """
+    Atualiza a posição da fila em memória e na planilha.
+    Com adiar_escrita, a escrita na planilha é feita em uma tarefa de fundo após
+    SYNC_POSICAO_DEBOUNCE segundos, agrupada com outras atualizações próximas;
+    sem, é feita imediatamente.
+    """
+    global memoria_fila_position, posicao_pendente_sync
     
-    total_corretores = len(fila_corretores)
+    # SEMPRE atualiza em memória primeiro
+    memoria_fila_position = position
+    print(f"Posição da fila atualizada em memória: {position}")
+    
+    if not _SHEETS_OK:
+        print("Google Sheets não configurado, usando apenas memória")
+        return
+    
+    if not adiar_escrita:
+        sincronizar_posicao_no_sheets(position)
+        return
     
-    for i, corretor in enumerate(fila_corretores):
-        # Determina a mensagem baseada na posição
-        if corretor.posicao_fila == 1:
-            mensagem = f"""🎯 *AGORA É SUA VEZ!*
+    # Enquanto a escrita estiver pendente, a posição em memória prevalece sobre a da planilha
+    posicao_pendente_sync = True
+    _agendar_flush_position()
+    print(f"⏳ Sincronização com Google Sheets agendada em {SYNC_POSICAO_DEBOUNCE}s")
 
-Olá {corretor.nome}! 
+def get_redis():
+    """Retorna o cliente Redis (ou None se REDIS_URL não estiver configurado)"""
+    global _redis_client
+    
+    if not REDIS_URL:
+        return None
+    
+    if _redis_client is None:
+        _redis_client = redis_asyncio.Redis.from_url(
+            REDIS_URL,
+            decode_responses=True,
+            socket_timeout=REDIS_TIMEOUT,
+            socket_connect_timeout=REDIS_TIMEOUT
+        )
+    return _redis_client
 
-Você está em *1º lugar* na fila de atendimento! 📞
+async def fechar_redis():
+    """Fecha o cliente Redis (se foi criado)"""
+    global _redis_client
+    
+    if _redis_client is not None:
+        await _redis_client.aclose()
+        _redis_client = None
 
-O próximo cliente será direcionado para você.
+async def carregar_estado():
+    """
+    Busca corretores e posição da fila (load_state). Com Redis configurado, a posição
+    salva no Redis prevalece sobre a da planilha.
+    """
+    global memoria_fila_position, _redis_desatualizado
+    
+    redis_client = get_redis()
+    if redis_client is None:
+        return await asyncio.to_thread(load_state)
+    
+    valor = None
+    if not _redis_desatualizado:
+        try:
+            valor = await redis_client.get(REDIS_FILA_KEY)
+        except Exception as e:
+            print(f"⚠️ Erro ao ler posição do Redis: {str(e)}, usando posição da planilha")
+            return await asyncio.to_thread(load_state)
+    
+    if valor is not None:
+        # A posição vem do Redis: da planilha só são necessários os corretores
+        corretores, _ = await asyncio.to_thread(load_state, False)
+        memoria_fila_position = int(valor)
+        print(f"Posição da fila lida do Redis: {memoria_fila_position}")
+        return corretores, memoria_fila_position
+    
+    # Redis vazio (primeira execução) ou defasado: parte da posição da planilha/memória
+    corretores, fila_position = await asyncio.to_thread(load_state)
+    try:
+        await redis_client.set(REDIS_FILA_KEY, fila_position)
+        print(f"Posição da fila {'restaurada' if _redis_desatualizado else 'inicializada'} no Redis: {fila_position}")
+        _redis_desatualizado = False
+    except Exception as e:
+        print(f"⚠️ Erro ao gravar posição no Redis: {str(e)}, usando posição da planilha: {fila_position}")
+    return corretores, fila_position
 
-_Equipe Realiza Imóveis_ 🏡"""
-        else:
-            mensagem = f"""📋 *POSIÇÃO NA FILA ATUALIZADA*
+async def salvar_posicao_fila(position: int, adiar_escrita: bool = False):
+    """
+    Salva a posição da fila. Com Redis configurado, grava apenas no Redis e deixa a
+    planilha para a sincronização periódica; sem Redis (ou se ele falhar), usa
+    update_fila_position_in_sheets.
+    """
+    global memoria_fila_position, posicao_pendente_sync, _redis_desatualizado
+    
+    redis_client = get_redis()
+    if redis_client is not None:
+        try:
+            await redis_client.set(REDIS_FILA_KEY, position)
+            memoria_fila_position = position
+            posicao_pendente_sync = True
+            _redis_desatualizado = False
+            print(f"Posição da fila salva no Redis: {position} (Google Sheets sincronizado a cada {SYNC_SHEETS_INTERVALO}s)")
+            return
+        except Exception as e:
+            print(f"⚠️ Erro ao salvar posição no Redis: {str(e)}, usando Google Sheets")
+        
+        # O valor que ficou no Redis é anterior a esta posição: não deve ser lido de novo
+        _redis_desatualizado = True
+        try:
+            await redis_client.delete(REDIS_FILA_KEY)
+            _redis_desatualizado = False
+        except Exception as e:
+            print(f"⚠️ Erro ao remover posição defasada do Redis: {str(e)}")
+    
+    update_fila_position_in_sheets(position, adiar_escrita)
 
-Olá {corretor.nome}!
+async def _flush_posicao_redis():
+    """Grava na planilha a última posição salva no Redis, se ainda não sincronizada"""
+    global posicao_pendente_sync
+    
+    if not _SHEETS_OK:
+        return
+    
+    # Sob o lock da fila: a posição não muda entre a leitura e a escrita
+    async with _fila_lock:
+        if not posicao_pendente_sync:
+            return
+        
+        position = memoria_fila_position
+        if not _redis_desatualizado:
+            try:
+                # Outra instância da API pode ter avançado a fila depois desta
+                valor = await get_redis().get(REDIS_FILA_KEY)
+                if valor is not None:
+                    position = int(valor)
+            except Exception as e:
+                print(f"⚠️ Erro ao ler posição do Redis: {str(e)}, sincronizando posição em memória")
+        
+        if await asyncio.to_thread(sincronizar_posicao_no_sheets, position):
+            posicao_pendente_sync = False
 
-Sua posição atual: *{corretor.posicao_fila}º lugar* 
+async def _sincronizar_redis_periodicamente():
+    """Tarefa de fundo: a cada SYNC_SHEETS_INTERVALO segundos grava a posição do Redis na planilha"""
+    while True:
+        await asyncio.sleep(SYNC_SHEETS_INTERVALO)
+        await _flush_posicao_redis()
 
-🎯 Corretor atual: {corretor_atual.nome}
+def get_http_client() -> httpx.AsyncClient:
+    """Retorna o cliente HTTP da Evolution API, mantendo as conexões abertas entre envios"""
+    global _http_client
+    
+    if _http_client is None or _http_client.is_closed:
+        _http_client = httpx.AsyncClient(
+            timeout=30,
+            limits=HTTP_POOL_LIMITS,
+            headers={
+                "Content-Type": "application/json",
+                "apikey": EVOLUTION_API_KEY
+            }
+        )
+    return _http_client
 
-_Equipe Realiza Imóveis_ 🏡"""
-        
-        # Payload da mensagem
-        payload = {
-            "number": corretor.telefone,
-            "text": mensagem
-        }
-        
+async def fechar_http_client():
+    """Fecha o cliente HTTP da Evolution API (se foi criado)"""
+    global _http_client
+    
+    if _http_client is not None:
+        await _http_client.aclose()
+        _http_client = None
+
+def agendar_envios(total: int) -> List[float]:
+    """
+    Calcula de uma vez quando cada envio deve começar (segundos a partir de agora):
+    o primeiro sai imediatamente e os seguintes são espaçados por um intervalo
+    aleatório entre NOTIFICACOES_INTERVALO_MIN e NOTIFICACOES_INTERVALO_MAX
+    """
+    agenda = []
+    inicio = 0.0
+    for i in range(total):
+        if i > 0:
+            inicio += random.uniform(NOTIFICACOES_INTERVALO_MIN, NOTIFICACOES_INTERVALO_MAX)
+        agenda.append(inicio)
+    return agenda
+
+def novo_ritmo_envios() -> dict:
+    """Estado compartilhado pelos envios de um lote: horário do último início real"""
+    return {"lock": asyncio.Lock(), "ultimo_inicio": None}
+
+async def _aguardar_intervalo_minimo(ritmo: dict):
+    """
+    Garante NOTIFICACOES_INTERVALO_MIN segundos entre os inícios reais dos envios.
+    A agenda já espaça os inícios, mas um envio que esperou vaga no semáforo
+    poderia sair colado ao anterior quando as requisições em andamento demoram
+    """
+    loop = asyncio.get_running_loop()
+    async with ritmo["lock"]:
+        if ritmo["ultimo_inicio"] is not None:
+            espera = ritmo["ultimo_inicio"] + NOTIFICACOES_INTERVALO_MIN - loop.time()
+            if espera > 0:
+                await asyncio.sleep(espera)
+        ritmo["ultimo_inicio"] = loop.time()
+
+async def _enviar_notificacao(corretor: CorretorInternal, corretor_atual: CorretorInternal, semaforo: asyncio.Semaphore, atraso: float, ritmo: dict) -> NotificacaoStatus:
+    """Envia a notificação WhatsApp de um corretor após `atraso` segundos e retorna o status do envio"""
+    client = get_http_client()
+    
+    # Determina a mensagem baseada na posição
+    if corretor.posicao_fila == 1:
+        mensagem = _TPL_FIRST.format_map({'nome': corretor.nome})
+    else:
+        mensagem = _TPL_OTHER.format_map({
+            'nome': corretor.nome,
+            'pos': corretor.posicao_fila,
+            'atual': corretor_atual.nome
+        })
+    
+    # Payload da mensagem
+    payload = {
+        "number": corretor.telefone,
+        "text": mensagem
+    }
+    
+    # Aguarda o horário agendado (fora do semáforo: a espera não ocupa vaga de envio)
+    if atraso > 0:
+        print(f"⏳ Envio para {corretor.nome} agendado em {atraso:.1f}s...")
+        await asyncio.sleep(atraso)
+    
+    async with semaforo:
+        await _aguardar_intervalo_minimo(ritmo)
         try:
             print(f"📱 Enviando mensagem para {corretor.nome} (posição {corretor.posicao_fila})...")
             
             # Envia a mensagem
-            response = requests.post(
-                EVOLUTION_API_URL,
-                headers=headers,
-                json=payload,
-                timeout=30
-            )
+            response = await client.post(EVOLUTION_API_URL, json=payload)
             
             if response.status_code == 200 or response.status_code == 201:
                 print(f"✅ Mensagem enviada com sucesso para {corretor.nome}")
-                notificacoes_status.append(NotificacaoStatus(
+                return NotificacaoStatus(
                     corretor_nome=corretor.nome,
                     telefone=corretor.telefone,
                     sucesso=True,
                     status_code=response.status_code
-                ))
-            else:
-                error_msg = response.text
-                print(f"❌ Erro ao enviar mensagem para {corretor.nome}: {error_msg}")
-                notificacoes_status.append(NotificacaoStatus(
-                    corretor_nome=corretor.nome,
-                    telefone=corretor.telefone,
-                    sucesso=False,
-                    erro=error_msg,
-                    status_code=response.status_code
-                ))
-                
+                )
+            
+            error_msg = response.text
+            print(f"❌ Erro ao enviar mensagem para {corretor.nome}: {error_msg}")
+            return NotificacaoStatus(
+                corretor_nome=corretor.nome,
+                telefone=corretor.telefone,
+                sucesso=False,
+                erro=error_msg,
+                status_code=response.status_code
+            )
+            
         except Exception as e:
             error_msg = str(e)
             print(f"❌ Erro ao enviar mensagem para {corretor.nome}: {error_msg}")
-            notificacoes_status.append(NotificacaoStatus(
+            return NotificacaoStatus(
                 corretor_nome=corretor.nome,
                 telefone=corretor.telefone,
                 sucesso=False,
                 erro=error_msg
-            ))
-        
-        # Delay aleatório entre envios (exceto no último)
-        if i < total_corretores - 1:  # Não aplica delay no último envio
-            delay = random.uniform(3, 8)  # Delay aleatório entre 3 e 8 segundos
-            print(f"⏳ Aguardando {delay:.1f}s antes do próximo envio...")
-            time.sleep(delay)
+            )
+
+async def send_whatsapp_notifications_async(fila_corretores: List[CorretorInternal], corretor_atual: CorretorInternal) -> List[NotificacaoStatus]:
+    """
+    Envia notificações WhatsApp para todos os corretores sobre suas posições na fila.
+    Os envios seguem a agenda de agendar_envios (intervalo aleatório entre os inícios,
+    para evitar banimento da API) e a latência de cada requisição se sobrepõe à espera
+    pelo próximo (até NOTIFICACOES_CONCORRENCIA simultâneos)
+    """
+    if not EVOLUTION_API_URL or not EVOLUTION_API_KEY:
+        print("⚠️ Evolution API não configurada - notificações desabilitadas")
+        return []
+    
+    semaforo = asyncio.Semaphore(NOTIFICACOES_CONCORRENCIA)
+    ritmo = novo_ritmo_envios()
+    agenda = agendar_envios(len(fila_corretores))
     
-    return notificacoes_status
+    # gather preserva a ordem da fila nos resultados
+    notificacoes_status = await asyncio.gather(*[
+        _enviar_notificacao(c, corretor_atual, semaforo, atraso, ritmo)
+        for c, atraso in zip(fila_corretores, agenda)
+    ])
+    
+    return list(notificacoes_status)
+
+async def send_whatsapp_notifications_async_iter(fila_corretores: List[CorretorInternal], corretor_atual: CorretorInternal):
+    """
+    Igual a send_whatsapp_notifications_async, mas entrega cada status assim que o
+    respectivo envio termina (ordem de conclusão, não da fila)
+    """
+    if not EVOLUTION_API_URL or not EVOLUTION_API_KEY:
+        print("⚠️ Evolution API não configurada - notificações desabilitadas")
+        return
+    
+    semaforo = asyncio.Semaphore(NOTIFICACOES_CONCORRENCIA)
+    ritmo = novo_ritmo_envios()
+    agenda = agendar_envios(len(fila_corretores))
+    tarefas = [
+        asyncio.create_task(_enviar_notificacao(c, corretor_atual, semaforo, atraso, ritmo))
+        for c, atraso in zip(fila_corretores, agenda)
+    ]
+    
+    try:
+        for proxima in asyncio.as_completed(tarefas):
+            yield await proxima
+    finally:
+        # Cliente desconectou antes do fim: cancela os envios que ainda não começaram
+        for tarefa in tarefas:
+            tarefa.cancel()
 
 @app.get("/")
 async def root():
@@ -435,7 +1044,7 @@ async def health_check():
         "EVOLUTION_API_URL": bool(EVOLUTION_API_URL and EVOLUTION_API_URL != "https://placeholder-api.com/api"),
         "EVOLUTION_API_KEY": bool(EVOLUTION_API_KEY and EVOLUTION_API_KEY != "placeholder_key"),
         "GOOGLE_CREDENTIALS_JSON": bool(GOOGLE_CREDENTIALS_JSON and GOOGLE_CREDENTIALS_JSON != '{"type":"service_account","project_id":"placeholder"}'),
-        "google_sheets_configurado": is_google_sheets_configured()
+        "google_sheets_configurado": _SHEETS_OK
     }
     
     return {
@@ -446,55 +1055,48 @@ async def health_check():
     }
 
 @app.post("/proximo-corretor", response_model=FilaResponse)
-async def get_proximo_corretor(enviar_notificacoes: bool = False):
+async def get_proximo_corretor(background_tasks: BackgroundTasks, enviar_notificacoes: bool = False):
     """
     Retorna o próximo corretor da fila e avança a fila.
     O corretor atual vai para o final da fila e os outros avançam.
     Lida automaticamente com adições/remoções de corretores na planilha.
     
     Args:
-        enviar_notificacoes: Se True, envia notificações WhatsApp (default: False)
+        enviar_notificacoes: Se True, agenda o envio das notificações WhatsApp em
+            segundo plano, após a resposta (default: False). Para obter o status
+            de cada envio use o endpoint /enviar-notificacoes.
     """
-    global cache_hash, cache_fila
-    
     try:
-        # Busca corretores atuais da planilha
-        corretores_atual = get_corretores_from_sheets()
-        
-        if not corretores_atual:
-            raise HTTPException(status_code=404, detail="Nenhum corretor encontrado na planilha")
-        
-        # Detecta mudanças específicas na planilha
-        mudancas = detectar_mudancas_planilha(corretores_atual)
-        
-        # Busca posição atual da fila
-        fila_position = get_fila_position_from_sheets()
-        
-        # Ajusta posição baseado nas mudanças detectadas
-        if mudancas["houve_mudanca"]:
-            nova_posicao = ajustar_posicao_fila_por_mudancas(mudancas, fila_position, corretores_atual)
-            if nova_posicao != fila_position:
-                update_fila_position_in_sheets(nova_posicao)
-                fila_position = nova_posicao
-        
-        # Organiza a fila: corretor atual + próximos
-        total_corretores = len(corretores_atual)
-        
-        # Corretor atual é o da posição atual
-        corretor_atual = corretores_atual[fila_position]
-        corretor_atual.posicao_fila = 1
-        
-        # Organiza os próximos corretores
-        proximos_corretores = []
-        for i in range(1, total_corretores):
-            index = (fila_position + i) % total_corretores
-            corretor = corretores_atual[index]
-            corretor.posicao_fila = i + 1
-            proximos_corretores.append(corretor)
-        
-        # AVANÇA A FILA: próxima posição
-        nova_posicao = (fila_position + 1) % total_corretores
-        update_fila_position_in_sheets(nova_posicao)
+        # Leitura, ajuste e avanço da posição em seção crítica: requisições simultâneas
+        # não entregam o mesmo corretor nem gravam a mesma posição duas vezes
+        async with _fila_lock:
+            # Busca corretores atuais e posição da fila em uma única leitura da planilha
+            corretores_atual, fila_position = await carregar_estado()
+            
+            if not corretores_atual:
+                raise HTTPException(status_code=404, detail="Nenhum corretor encontrado na planilha")
+            
+            # Detecta mudanças específicas na planilha
+            mudancas = detectar_mudancas_planilha(corretores_atual)
+            
+            # Ajusta posição baseado nas mudanças detectadas
+            if mudancas["houve_mudanca"]:
+                nova_posicao = ajustar_posicao_fila_por_mudancas(mudancas, fila_position, corretores_atual)
+                if nova_posicao != fila_position:
+                    await salvar_posicao_fila(nova_posicao, adiar_escrita=True)
+                    fila_position = nova_posicao
+            
+            # Organiza a fila: corretor atual + próximos
+            total_corretores = len(corretores_atual)
+            fila_completa = montar_fila_rotacionada(corretores_atual, fila_position)
+            
+            # Corretor atual é o da posição atual, seguido dos próximos
+            corretor_atual = fila_completa[0]
+            proximos_corretores = fila_completa[1:]
+            
+            # AVANÇA A FILA: próxima posição
+            nova_posicao = (fila_position + 1) % total_corretores
+            await salvar_posicao_fila(nova_posicao, adiar_escrita=True)
         
         print(f"Corretor atual: {corretor_atual.nome}")
         print(f"Fila avançou de posição {fila_position} para {nova_posicao}")
@@ -502,76 +1104,73 @@ async def get_proximo_corretor(enviar_notificacoes: bool = False):
         if mudancas["houve_mudanca"]:
             print("📋 Mudanças na equipe detectadas e fila ajustada automaticamente!")
         
-        # Envia notificações via WhatsApp apenas se solicitado
-        notificacoes_status = []
+        # Agenda notificações via WhatsApp apenas se solicitado (executadas após a resposta)
         if enviar_notificacoes:
-            print("📱 Enviando notificações WhatsApp...")
-            fila_completa = [corretor_atual] + proximos_corretores
-            notificacoes_status = send_whatsapp_notifications(fila_completa, corretor_atual)
+            print("📱 Agendando notificações WhatsApp em segundo plano...")
+            background_tasks.add_task(send_whatsapp_notifications_async, fila_completa, corretor_atual)
         else:
             print("📱 Notificações WhatsApp não solicitadas (use parâmetro enviar_notificacoes=true ou endpoint /enviar-notificacoes)")
         
         return FilaResponse(
-            corretor_atual=corretor_atual,
-            proximos_corretores=proximos_corretores,
+            corretor_atual=corretor_atual.to_model(),
+            proximos_corretores=[c.to_model() for c in proximos_corretores],
             timestamp=datetime.now().isoformat(),
             fila_alterada=mudancas["houve_mudanca"],
-            notificacoes_whatsapp=notificacoes_status
+            notificacoes_whatsapp=[],
+            notificacoes_agendadas=enviar_notificacoes
         )
         
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Erro interno: {str(e)}")
 
+async def carregar_fila_para_notificacoes():
+    """Lê a fila atual (sem avançar) e retorna (fila_completa, corretor_atual) para notificar"""
+    # Busca corretores atuais e posição da fila em uma única leitura da planilha
+    # (aguarda um avanço em andamento para não notificar uma posição desatualizada)
+    async with _fila_lock:
+        corretores_atual, fila_position = await carregar_estado()
+    
+    if not corretores_atual:
+        raise HTTPException(status_code=404, detail="Nenhum corretor encontrado na planilha")
+    
+    # Organiza a fila: corretor atual + próximos
+    fila_completa = montar_fila_rotacionada(corretores_atual, fila_position)
+    
+    return fila_completa, fila_completa[0]
+
+def calcular_estatisticas_notificacoes(notificacoes_status: List[NotificacaoStatus]) -> Dict[str, Any]:
+    """Resume os envios: total, sucessos, falhas e taxa de sucesso (%)"""
+    sucessos = sum(1 for n in notificacoes_status if n.sucesso)
+    falhas = len(notificacoes_status) - sucessos
+    
+    return {
+        "total_envios": len(notificacoes_status),
+        "sucessos": sucessos,
+        "falhas": falhas,
+        "taxa_sucesso": round((sucessos / len(notificacoes_status)) * 100, 1) if notificacoes_status else 0
+    }
+
 @app.post("/enviar-notificacoes")
 async def enviar_notificacoes_fila():
     """
     Envia notificações WhatsApp para todos os corretores sobre suas posições na fila atual.
     Este endpoint pode ser chamado separadamente para melhor performance.
+    Diferente de /proximo-corretor?enviar_notificacoes=true, aguarda todos os envios
+    e retorna as estatísticas e o status de cada um.
     """
     try:
-        # Busca corretores atuais da planilha
-        corretores_atual = get_corretores_from_sheets()
-        
-        if not corretores_atual:
-            raise HTTPException(status_code=404, detail="Nenhum corretor encontrado na planilha")
-        
-        # Busca posição atual da fila
-        fila_position = get_fila_position_from_sheets()
-        
-        # Organiza a fila: corretor atual + próximos
-        total_corretores = len(corretores_atual)
-        
-        # Corretor atual é o da posição atual
-        corretor_atual = corretores_atual[fila_position]
-        corretor_atual.posicao_fila = 1
-        
-        # Organiza os próximos corretores
-        fila_completa = [corretor_atual]
-        for i in range(1, total_corretores):
-            index = (fila_position + i) % total_corretores
-            corretor = corretores_atual[index]
-            corretor.posicao_fila = i + 1
-            fila_completa.append(corretor)
+        fila_completa, corretor_atual = await carregar_fila_para_notificacoes()
         
         print(f"📱 Enviando notificações WhatsApp para {len(fila_completa)} corretores...")
         print(f"🎯 Corretor atual: {corretor_atual.nome}")
         
         # Envia notificações via WhatsApp
-        notificacoes_status = send_whatsapp_notifications(fila_completa, corretor_atual)
-        
-        # Calcula estatísticas
-        sucessos = sum(1 for n in notificacoes_status if n.sucesso)
-        falhas = len(notificacoes_status) - sucessos
+        notificacoes_status = await send_whatsapp_notifications_async(fila_completa, corretor_atual)
         
         return {
             "message": f"Notificações processadas para {len(fila_completa)} corretores",
             "corretor_atual": corretor_atual.nome,
-            "estatisticas": {
-                "total_envios": len(notificacoes_status),
-                "sucessos": sucessos,
-                "falhas": falhas,
-                "taxa_sucesso": round((sucessos / len(notificacoes_status)) * 100, 1) if notificacoes_status else 0
-            },
+            "estatisticas": calcular_estatisticas_notificacoes(notificacoes_status),
             "notificacoes_detalhadas": notificacoes_status,
             "timestamp": datetime.now().isoformat()
         }
@@ -579,6 +1178,37 @@ async def enviar_notificacoes_fila():
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Erro interno: {str(e)}")
 
+@app.post("/enviar-notificacoes-stream")
+async def enviar_notificacoes_fila_stream():
+    """
+    Igual a /enviar-notificacoes, mas responde com Server-Sent Events: cada
+    NotificacaoStatus é enviado (evento 'notificacao') assim que o envio termina,
+    e as estatísticas chegam no evento final 'resumo'.
+    """
+    try:
+        fila_completa, corretor_atual = await carregar_fila_para_notificacoes()
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Erro interno: {str(e)}")
+    
+    print(f"📱 Enviando notificações WhatsApp (stream) para {len(fila_completa)} corretores...")
+    print(f"🎯 Corretor atual: {corretor_atual.nome}")
+    
+    async def gerar_eventos():
+        notificacoes_status = []
+        async for status in send_whatsapp_notifications_async_iter(fila_completa, corretor_atual):
+            notificacoes_status.append(status)
+            yield f"event: notificacao\ndata: {orjson.dumps(status.model_dump()).decode()}\n\n"
+        
+        resumo = {
+            "message": f"Notificações processadas para {len(fila_completa)} corretores",
+            "corretor_atual": corretor_atual.nome,
+            "estatisticas": calcular_estatisticas_notificacoes(notificacoes_status),
+            "timestamp": datetime.now().isoformat()
+        }
+        yield f"event: resumo\ndata: {orjson.dumps(resumo).decode()}\n\n"
+    
+    return StreamingResponse(gerar_eventos(), media_type="text/event-stream")
+
 @app.get("/fila-atual", response_model=FilaResponse)
 async def get_fila_atual():
     """
@@ -586,44 +1216,35 @@ async def get_fila_atual():
     Detecta e ajusta automaticamente mudanças na planilha.
     """
     try:
-        # Busca corretores atuais da planilha
-        corretores_atual = get_corretores_from_sheets()
-        
-        if not corretores_atual:
-            raise HTTPException(status_code=404, detail="Nenhum corretor encontrado na planilha")
-        
-        # Detecta mudanças específicas na planilha
-        mudancas = detectar_mudancas_planilha(corretores_atual)
-        
-        # Busca posição atual da fila
-        fila_position = get_fila_position_from_sheets()
-        
-        # Ajusta posição baseado nas mudanças detectadas
-        if mudancas["houve_mudanca"]:
-            nova_posicao = ajustar_posicao_fila_por_mudancas(mudancas, fila_position, corretores_atual)
-            if nova_posicao != fila_position:
-                update_fila_position_in_sheets(nova_posicao)
-                fila_position = nova_posicao
-                print("📋 Mudanças na equipe detectadas e fila ajustada automaticamente!")
+        # Ajustes de posição por mudanças na planilha também passam pela seção crítica
+        async with _fila_lock:
+            # Busca corretores atuais e posição da fila em uma única leitura da planilha
+            corretores_atual, fila_position = await carregar_estado()
+            
+            if not corretores_atual:
+                raise HTTPException(status_code=404, detail="Nenhum corretor encontrado na planilha")
+            
+            # Detecta mudanças específicas na planilha
+            mudancas = detectar_mudancas_planilha(corretores_atual)
+            
+            # Ajusta posição baseado nas mudanças detectadas
+            if mudancas["houve_mudanca"]:
+                nova_posicao = ajustar_posicao_fila_por_mudancas(mudancas, fila_position, corretores_atual)
+                if nova_posicao != fila_position:
+                    await salvar_posicao_fila(nova_posicao, adiar_escrita=True)
+                    fila_position = nova_posicao
+                    print("📋 Mudanças na equipe detectadas e fila ajustada automaticamente!")
         
         # Organiza a fila: corretor atual + próximos
-        total_corretores = len(corretores_atual)
+        fila_completa = montar_fila_rotacionada(corretores_atual, fila_position)
         
-        # Corretor atual é o da posição atual
-        corretor_atual = corretores_atual[fila_position]
-        corretor_atual.posicao_fila = 1
-        
-        # Organiza os próximos corretores
-        proximos_corretores = []
-        for i in range(1, total_corretores):
-            index = (fila_position + i) % total_corretores
-            corretor = corretores_atual[index]
-            corretor.posicao_fila = i + 1
-            proximos_corretores.append(corretor)
+        # Corretor atual é o da posição atual, seguido dos próximos
+        corretor_atual = fila_completa[0]
+        proximos_corretores = fila_completa[1:]
         
         return FilaResponse(
-            corretor_atual=corretor_atual,
-            proximos_corretores=proximos_corretores,
+            corretor_atual=corretor_atual.to_model(),
+            proximos_corretores=[c.to_model() for c in proximos_corretores],
             timestamp=datetime.now().isoformat(),
             fila_alterada=mudancas["houve_mudanca"],
             notificacoes_whatsapp=[]
@@ -638,7 +1259,8 @@ async def reset_fila():
     Reseta a fila para o primeiro corretor
     """
     try:
-        update_fila_position_in_sheets(0)
+        async with _fila_lock:
+            await salvar_posicao_fila(0, adiar_escrita=True)
         return {"message": "Fila resetada com sucesso", "timestamp": datetime.now().isoformat()}
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Erro ao resetar fila: {str(e)}")
@@ -648,18 +1270,19 @@ async def sync_google_sheets():
     """
     Força sincronização da posição da fila com Google Sheets
     """
-    global memoria_fila_position
+    global memoria_fila_position, posicao_pendente_sync
     
-    if not is_google_sheets_configured():
+    if not _SHEETS_OK:
         return {"message": "Google Sheets não configurado", "posicao_memoria": memoria_fila_position}
     
+    # Grava imediatamente uma posição que ainda esteja aguardando sincronização
+    async with _fila_lock:
+        if posicao_pendente_sync and await asyncio.to_thread(sincronizar_posicao_no_sheets, memoria_fila_position):
+            posicao_pendente_sync = False
+    
     try:
-        client = get_google_sheets_client()
-        sheet = client.open_by_key(SPREADSHEET_ID)
-        
         try:
-            config_sheet = sheet.worksheet('Config')
-            position = config_sheet.acell('A2').value
+            position = executar_no_google_sheets(lambda: get_config_worksheet().acell('A2').value)
             posicao_sheets = int(position) if position else 0
             
             return {
@@ -668,10 +1291,8 @@ async def sync_google_sheets():
                 "posicao_memoria": memoria_fila_position,
                 "diferenca": abs(posicao_sheets - memoria_fila_position)
             }
-        except:
-            config_sheet = sheet.add_worksheet(title='Config', rows=10, cols=2)
-            config_sheet.update('A1', 'fila_position')
-            config_sheet.update('A2', str(memoria_fila_position))
+        except gspread.exceptions.WorksheetNotFound:
+            criar_config_worksheet()
             
             return {
                 "message": "Aba Config criada e sincronizada",
@@ -679,6 +1300,7 @@ async def sync_google_sheets():
             }
             
     except Exception as e:
+        invalidar_cache_google_sheets()
         return {"error": f"Erro na sincronização: {str(e)}"}
 
 @app.get("/status-notificacoes")
@@ -711,7 +1333,7 @@ async def status_notificacoes():
             "gerenciar_fila": {
                 "endpoint": "POST /proximo-corretor",
                 "funcao": "Avança fila rapidamente (sem notificações por padrão)",
-                "parametro_opcional": "?enviar_notificacoes=true para incluir notificações",
+                "parametro_opcional": "?enviar_notificacoes=true para agendar notificações em segundo plano",
                 "performance": "🚀 Rápido - apenas gerencia posições"
             },
             "enviar_notificacoes": {
@@ -720,6 +1342,12 @@ async def status_notificacoes():
                 "performance": "📱 Independente - pode ser executado em paralelo",
                 "retorno": "Estatísticas detalhadas + status individual"
             },
+            "enviar_notificacoes_stream": {
+                "endpoint": "POST /enviar-notificacoes-stream",
+                "funcao": "Envia notificações WhatsApp para fila atual via Server-Sent Events",
+                "performance": "📡 Progressivo - cada status chega assim que o envio termina",
+                "retorno": "Eventos 'notificacao' (status individual) + evento final 'resumo' (estatísticas)"
+            },
             "consultar_fila": {
                 "endpoint": "GET /fila-atual",
                 "funcao": "Consulta fila sem alterações ou notificações",